@@ -13,13 +13,13 @@ Working out coordinates for a bounding box with 3 mile radius from original lat/
 URL (version: 2015-02-13): https://math.stackexchange.com/q/1146457
 """
 
-import math
+import numpy as np
 
 def boundingBox(lat, lon, s=0.15, mode=2):
     """
     Arguments:
-        lat: Latitude of location
-        lon: Longitude of location
+        lat: Latitude of location, either a scalar or an array of latitudes
+        lon: Longitude of location, either a scalar or an array of longitudes
         s: arc length in km, default 0.15km radius around center point
         mode: Select which boundaries to return
     """
@@ -28,32 +28,34 @@ def boundingBox(lat, lon, s=0.15, mode=2):
     Modes:
         1: return all four boundaries upper left, upper right, lower left, lower right
         2: return only upper left and lower right boundaries
+    
+    For scalar input the boundaries are returned as (lat, lon) tuples, 
+    for array input as an array of shape (N, 4, 2) in mode 1 or (N, 2, 2) in mode 2.
     """
     
     r = 3963 # radius of earth in miles
     
     # convert coordinates to Radians
-    lat_rad = lat * math.pi / 180
-    lon_rad = lon * math.pi / 180
+    lat_rad = np.deg2rad(np.asarray(lat, dtype=np.float64))
+    lon_rad = np.deg2rad(np.asarray(lon, dtype=np.float64))
     
     upper_right = (lat_rad + s/r, lon_rad + s/r)
     lower_right = (lat_rad + s/r, lon_rad - s/r)
     upper_left = (lat_rad - s/r, lon_rad + s/r)
     lower_left = (lat_rad - s/r, lon_rad - s/r)
     
-    coordinates = (upper_left, upper_right, lower_left, lower_right)
+    if mode == 2:
+        coordinates = (upper_left, lower_right)
+    else:
+        coordinates = (upper_left, upper_right, lower_left, lower_right)
     
-    bounds = []
-    # convert Radians back to Degrees
-    for c in coordinates:
-        bounds.append(tuple(x*180/math.pi for x in c))
+    # convert Radians back to Degrees, shape (N, corners, 2)
+    bounds = np.rad2deg(np.stack([np.stack(c, axis=-1) for c in coordinates], axis=-2))
     
-    if mode == 1:
-        return bounds
-    elif mode == 2:
-        return bounds[0], bounds[3]
-    else:
-        return bounds
+    if bounds.ndim == 2:
+        bounds = [tuple(float(x) for x in c) for c in bounds]
+        return tuple(bounds) if mode == 2 else bounds
+    return bounds
 
     
 def main():
@@ -6,15 +6,81 @@ reference: https://docs.microsoft.com/en-us/bingmaps/articles/bing-maps-tile-sys
 """
 
 import math
-from itertools import chain
-import re
+from functools import lru_cache
+import numpy as np
+
+_DEG2RAD = math.pi / 180
+_RAD2DEG = 180 / math.pi
+_MINLAT, _MAXLAT = -85.05112878, 85.05112878
+_MINLON, _MAXLON = -180, 180
+
+def _latlon_to_pixel_scalar(latitude, longitude, levelOfDetail):
+    """
+    Counterpart of TileSystem.latLongToPixelXY, compiled by _batch_kernels.
+    """
+    latitude = min(max(latitude, _MINLAT), _MAXLAT)
+    longitude = min(max(longitude, _MINLON), _MAXLON)
+    
+    x = (longitude + 180) / 360
+    sinLatitude = math.sin(latitude * _DEG2RAD)
+    y = 0.5 - math.log((1 + sinLatitude) / (1 - sinLatitude)) / (4 * math.pi)
+    
+    mapSize = 256 << levelOfDetail
+    pixelX = int(min(max(x * mapSize + 0.5, 0), mapSize - 1))
+    pixelY = int(min(max(y * mapSize + 0.5, 0), mapSize - 1))
+    return pixelX, pixelY
+
+def _pixel_to_latlon_scalar(pixelX, pixelY, levelOfDetail):
+    """
+    Counterpart of TileSystem.pixelXYToLatLong, compiled by _batch_kernels.
+    """
+    mapSize = 256 << levelOfDetail
+    x = (min(max(pixelX, 0), mapSize - 1) / mapSize) - 0.5
+    y = 0.5 - (min(max(pixelY, 0), mapSize - 1) / mapSize)
+    
+    latitude = 90 - 2 * math.atan(math.exp(-y * 2 * math.pi)) * _RAD2DEG
+    longitude = 360 * x
+    return latitude, longitude
+
+@lru_cache(maxsize=1)
+def _batch_kernels():
+    """
+    Builds the batch conversion kernels on first use. numba is only imported here, so importing 
+    this module stays cheap; without numba the kernels run as plain python.
+    Compiled kernels are cached next to this file (numba cache=True); set NUMBA_CACHE_DIR 
+    before the first batch conversion to keep them somewhere else.
+    """
+    try:
+        from numba import njit, prange
+    except ImportError:
+        # numba is optional, fall back to plain python
+        def njit(*args, **kwargs):
+            return lambda f: f
+        prange = range
+    
+    latlon_to_pixel = njit(cache=True, fastmath=True)(_latlon_to_pixel_scalar)
+    pixel_to_latlon = njit(cache=True, fastmath=True)(_pixel_to_latlon_scalar)
+    
+    @njit(cache=True, parallel=True)
+    def latlon_to_pixel_batch(latitudes, longitudes, levelOfDetail, out_x, out_y):
+        for i in prange(latitudes.size):
+            out_x[i], out_y[i] = latlon_to_pixel(latitudes[i], longitudes[i], levelOfDetail)
+    
+    @njit(cache=True, parallel=True)
+    def pixel_to_latlon_batch(pixelX, pixelY, levelOfDetail, out_lat, out_lon):
+        for i in prange(pixelX.size):
+            out_lat[i], out_lon[i] = pixel_to_latlon(pixelX[i], pixelY[i], levelOfDetail)
+    
+    return latlon_to_pixel_batch, pixel_to_latlon_batch
+
 
 class TileSystem(object):
     
     EARTHRADIUS = 6378137
-    MINLAT, MAXLAT  = -85.05112878, 85.05112878
-    MINLON, MAXLON= -180, 180
+    MINLAT, MAXLAT  = _MINLAT, _MAXLAT
+    MINLON, MAXLON= _MINLON, _MAXLON
     TILESIZE = 256 # BING Maps use 256x256 tiles
+    _MAP_SIZE = tuple(256 << l for l in range(24)) # map size lookup per level of detail
     
     @staticmethod
     def clip(n, minValue, maxValue):
@@ -29,7 +95,8 @@ class TileSystem(object):
             double: The clipped value.
         """
         
-        return min(max(n, minValue), maxValue)
+        # a conditional expression avoids the two builtin calls of min(max(...))
+        return minValue if n < minValue else (maxValue if n > maxValue else n)
     
     @staticmethod
     def mapSize(levelOfDetail):
@@ -43,6 +110,9 @@ class TileSystem(object):
         
         """
         
+        if 0 <= levelOfDetail < len(TileSystem._MAP_SIZE):
+            return TileSystem._MAP_SIZE[levelOfDetail]
+        # outside the table: same as before, negative levels raise ValueError
         return 256 << levelOfDetail
     
     @staticmethod
@@ -59,8 +129,8 @@ class TileSystem(object):
         
         """
         
-        latitude = TileSystem.clip(latitude, self.MINLAT, TileSystem.MAXLAT)
-        return math.cos(latitude * math.pi / 180) * 2 * math.pi * TileSystem.EARTHRADIUS / TileSystem.mapSize(levelOfDetail)
+        latitude = TileSystem.clip(latitude, TileSystem.MINLAT, TileSystem.MAXLAT)
+        return math.cos(latitude * _DEG2RAD) * 2 * math.pi * TileSystem.EARTHRADIUS / TileSystem.mapSize(levelOfDetail)
         
 
     @staticmethod
@@ -99,7 +169,7 @@ class TileSystem(object):
         longitude = TileSystem.clip(longitude, TileSystem.MINLON, TileSystem.MAXLON)
         
         x = (longitude + 180) / 360
-        sinLatitude = math.sin(latitude * math.pi / 180)
+        sinLatitude = math.sin(latitude * _DEG2RAD)
         y = 0.5 - math.log((1 + sinLatitude) / (1 - sinLatitude)) / (4 * math.pi)
         
         mapSize = TileSystem.mapSize(levelOfDetail)
@@ -108,6 +178,34 @@ class TileSystem(object):
         
         return pixelX, pixelY
     
+    @staticmethod
+    def latLongToPixelXY_vec(latitude, longitude, levelOfDetail):
+        """
+        Vectorized version of latLongToPixelXY, converting whole arrays of 
+        latitude/longitude WGS-84 coordinates (in degrees) into pixel XY coordinates at once.
+        
+        Args:
+            latitude (ndarray):     Latitudes of the points, in degrees.
+            longitude (ndarray):    Longitudes of the points, in degrees.
+            levelOfDetail (int):    Level of detail, from 1 (lowest detail) to 23 (highest detail).
+            
+        Returns:
+            pixelX (ndarray):   X coordinates in pixels.
+            pixelY (ndarray):   Y coordinates in pixels.
+        """
+        latitude = np.clip(latitude, TileSystem.MINLAT, TileSystem.MAXLAT)
+        longitude = np.clip(longitude, TileSystem.MINLON, TileSystem.MAXLON)
+        
+        x = (longitude + 180) / 360
+        sinLatitude = np.sin(np.deg2rad(latitude))
+        y = 0.5 - np.log((1 + sinLatitude) / (1 - sinLatitude)) / (4 * np.pi)
+        
+        mapSize = TileSystem.mapSize(levelOfDetail)
+        pixelX = np.clip(x * mapSize + 0.5, 0, mapSize - 1).astype(np.int64)
+        pixelY = np.clip(y * mapSize + 0.5, 0, mapSize - 1).astype(np.int64)
+        
+        return pixelX, pixelY
+    
     @staticmethod
     def pixelXYToLatLong(pixelX, pixelY, levelOfDetail):
         """
@@ -129,11 +227,55 @@ class TileSystem(object):
         x = (TileSystem.clip(pixelX, 0, mapSize - 1) / mapSize) - 0.5
         y = 0.5 - (TileSystem.clip(pixelY, 0, mapSize - 1) / mapSize)
         
-        latitude = 90 - 360 * math.atan(math.exp(-y * 2 * math.pi)) / math.pi
+        latitude = 90 - 2 * math.atan(math.exp(-y * 2 * math.pi)) * _RAD2DEG
         longitude = 360 * x
         
         return latitude, longitude
     
+    @staticmethod
+    def latLongToPixelXY_batch(latitude, longitude, levelOfDetail):
+        """
+        Converts arrays of latitude/longitude WGS-84 coordinates (in degrees) into 
+        pixel XY coordinates with a compiled, parallel kernel (if numba is installed, compiled on first call).
+        
+        Args:
+            latitude (ndarray):     Latitudes of the points, in degrees.
+            longitude (ndarray):    Longitudes of the points, in degrees.
+            levelOfDetail (int):    Level of detail, from 1 (lowest detail) to 23 (highest detail).
+            
+        Returns:
+            pixelX (ndarray):   X coordinates in pixels.
+            pixelY (ndarray):   Y coordinates in pixels.
+        """
+        latitude = np.ascontiguousarray(latitude, dtype=np.float64).ravel()
+        longitude = np.ascontiguousarray(longitude, dtype=np.float64).ravel()
+        pixelX = np.empty(latitude.size, dtype=np.int64)
+        pixelY = np.empty(latitude.size, dtype=np.int64)
+        _batch_kernels()[0](latitude, longitude, levelOfDetail, pixelX, pixelY)
+        return pixelX, pixelY
+    
+    @staticmethod
+    def pixelXYToLatLong_batch(pixelX, pixelY, levelOfDetail):
+        """
+        Converts arrays of pixel XY coordinates into latitude/longitude WGS-84 
+        coordinates (in degrees) with a compiled, parallel kernel (if numba is installed, compiled on first call).
+        
+        Args:
+            pixelX (ndarray):   X coordinates of the points, in pixels.
+            pixelY (ndarray):   Y coordinates of the points, in pixels.
+            levelOfDetail(int): Level of detail, from 1 (lowest detail) to 23 (highest detail).
+            
+        Returns:
+            latitude (ndarray):     Latitudes in degrees.
+            longitude (ndarray):    Longitudes in degrees.
+        """
+        pixelX = np.ascontiguousarray(pixelX, dtype=np.int64).ravel()
+        pixelY = np.ascontiguousarray(pixelY, dtype=np.int64).ravel()
+        latitude = np.empty(pixelX.size, dtype=np.float64)
+        longitude = np.empty(pixelX.size, dtype=np.float64)
+        _batch_kernels()[1](pixelX, pixelY, levelOfDetail, latitude, longitude)
+        return latitude, longitude
+    
     @staticmethod
     def pixelXYToTileXY(pixelX, pixelY):
         """
@@ -191,14 +333,63 @@ class TileSystem(object):
             str:    A string containing the Quadrant Key.
         """
         
-        # Thanks to Linlin Chen for this great workaround!
+        # interleave the bits of tileY and tileX, one base-4 digit per level
+        
+        digits = []
+        for i in range(levelOfDetail, 0, -1):
+            mask = 1 << (i - 1)
+            digit = ((tileX & mask) != 0) | (((tileY & mask) != 0) << 1)
+            digits.append(chr(0x30 + digit))
+        return ''.join(digits)
+            
+    
+    @staticmethod
+    @lru_cache(maxsize=24)
+    def quadKeyFunction(levelOfDetail):
+        """
+        Generates a tileXYToQuadKey function specialized to one level of detail, 
+        with the per-level loop unrolled and all shifts baked in as constants.
+        
+        Used by tileRangeToQuadKeys, which calls it once per bounding box.
         
-        tileXbits = '{0:0{1}b}'.format(tileX, levelOfDetail)
-        tileYbits = '{0:0{1}b}'.format(tileY, levelOfDetail)
+        Args:
+            levelOfDetail (int):    Level of detail, from 1 (lowest detail) to 23 (highest detail).
+            
+        Returns:
+            function:   quadKey(tileX, tileY) returning the QuadKey string.
+        """
         
-        quadkeybinary = ''.join(chain(*zip(tileYbits, tileXbits)))
-        return ''.join([str(int(num, 2)) for num in re.findall('..?', quadkeybinary)])
+        if levelOfDetail <= 0:
+            # no digits to emit, same result as tileXYToQuadKey
+            return lambda tileX, tileY: ''
+        
+        digits = ",\n        ".join(
+            "'0123'[((tileX >> {0}) & 1) | (((tileY >> {0}) & 1) << 1)]".format(levelOfDetail - 1 - i)
+            for i in range(levelOfDetail))
+        src = "def quadKey(tileX, tileY):\n    return ''.join((\n        {0},\n    ))\n".format(digits)
+        namespace = {}
+        exec(src, namespace)
+        return namespace['quadKey']
+    
+    @staticmethod
+    def tileRangeToQuadKeys(tileX1, tileY1, tileX2, tileY2, levelOfDetail):
+        """
+        Converts a whole range of tile XY coordinates into QuadKeys, using one 
+        quadKeyFunction specialized to the level of detail for all tiles.
+        
+        Args:
+            tileX1 (int):           Tile X Coordinate of the upper left tile.
+            tileY1 (int):           Tile Y Coordinate of the upper left tile.
+            tileX2 (int):           Tile X Coordinate of the lower right tile.
+            tileY2 (int):           Tile Y Coordinate of the lower right tile.
+            levelOfDetail (int):    Level of detail, from 1 (lowest detail) to 23 (highest detail).
             
+        Returns:
+            list:   The QuadKeys of all tiles, row by row from the upper left tile.
+        """
+        
+        quadKey = TileSystem.quadKeyFunction(levelOfDetail)
+        return [quadKey(tileX, tileY) for tileY in range(tileY1, tileY2 + 1) for tileX in range(tileX1, tileX2 + 1)]
     
     @staticmethod
     def quadKeyToTileXY(quadKey):
@@ -214,10 +405,11 @@ class TileSystem(object):
             levelOfDetail (int):    Level of Detail.
         """
         
-        # Thanks to Linlin Chen for this great workaround!
-        
-        quadkeybinary = ''.join(['{0:02b}'.format(int(num)) for num in quadKey])
-        tileX, tileY = int(quadkeybinary[1::2], 2), int(quadkeybinary[::2], 2)
+        tileX = tileY = 0
+        for c in quadKey:
+            digit = int(c)
+            tileX = (tileX << 1) | (digit & 1)
+            tileY = (tileY << 1) | ((digit >> 1) & 1)
         return tileX, tileY
         
         
@@ -7,11 +7,24 @@ Modified and Updated to use the latest Bing Maps API standards (2019).
 """
 
 MAXSIZE = 8192 * 8192 * 8 # maximum image size possible
+MAXWORKERS = 16 # number of tiles downloaded concurrently
+METADATA_CACHE = "./.bing_meta_{}.json" # local copy of the last imagery metadata response, per API key
+METADATA_TTL = 24 * 60 * 60 # seconds until the cached metadata is fetched again
+NULL_TILE = "./null.bin" # raw bytes of the NULL image, exactly as served by Bing
 
 import datetime
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
+from io import BytesIO
+import numpy as np
 from PIL import Image
 import requests
-from urllib import request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os, sys
 
 # import our bing tile system handler class
@@ -20,6 +33,57 @@ from BoundingBox import boundingBox as bb
 
 # https://docs.microsoft.com/en-us/bingmaps/rest-services/imagery/get-imagery-metadata
 BING_AVAILABILITY_URL = "http://dev.virtualearth.net/REST/V1/Imagery/Metadata/Aerial?output=json&key="
+BING_POINT_METADATA_URL = "http://dev.virtualearth.net/REST/V1/Imagery/Metadata/Aerial/{lat},{lon}?zl={zl}&output=json&key="
+
+def _retrying_session():
+    """
+    Create a keep-alive session pooled for MAXWORKERS threads, retrying transient server errors.
+    
+    Returns:
+        requests.Session: the configured session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=MAXWORKERS,
+                          max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504)))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@lru_cache(maxsize=1)
+def _fetch_bing_meta(api_key):
+    """
+    Fetch the imagery metadata for the given API key, reusing METADATA_CACHE for METADATA_TTL seconds.
+    Memoized, so only the first BingAerialImage of a process does any I/O.
+    
+    Returns:
+        tuple: (baseURL, subdomains, tileSize, maxZoom)
+    """
+    # name the cache after a hash of the key, so the key itself is not written to disk
+    cache = METADATA_CACHE.format(hashlib.sha256(api_key.encode()).hexdigest()[:16])
+    
+    if os.path.exists(cache) and time.time() - os.path.getmtime(cache) < METADATA_TTL:
+        try:
+            with open(cache, "r") as f:
+                meta = json.load(f)
+            data = meta["resourceSets"][0]["resources"][0]
+            return data["imageUrl"], data["imageUrlSubdomains"], data["imageHeight"], data["zoomMax"]
+        except (ValueError, KeyError, IndexError):
+            pass # corrupt cache, fetch again
+    
+    with _retrying_session() as session:
+        r = session.get(BING_AVAILABILITY_URL + api_key, timeout=10)
+    if r.status_code != 200:
+        raise Exception("API Call to Bing Maps failed.")
+    meta = json.loads(r.content)
+    
+    # write to a temporary file first, so concurrent or interrupted runs never see a partial cache
+    tmp = "{}.{}.tmp".format(cache, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, cache)
+    
+    data = meta["resourceSets"][0]["resources"][0]
+    return data["imageUrl"], data["imageUrlSubdomains"], data["imageHeight"], data["zoomMax"]
 
 class BingAerialImage(object):
     
@@ -27,11 +91,19 @@ class BingAerialImage(object):
         self.lat = lat
         self.lon = lon
         self.arc = s
-        self.upper_left = bb(self.lat, self.lon, self.arc, 2)[0] # tupel (X,Y)
-        self.lower_right = bb(self.lat, self.lon, self.arc, 2)[1] # tupel (X,Y)
+        self.upper_left, self.lower_right = bb(self.lat, self.lon, self.arc, 2) # tupels (X,Y)
         self.api_key = open("apikey.txt", "r").readline().rstrip()
         
+        # one keep-alive session shared by all download threads
+        self.session = _retrying_session()
+        
         self.currentBaseURL() # retrieve currently available domains for aerial images
+        null_bytes = self._fetch_null()
+        self._null_size = len(null_bytes)
+        self._null_sha = hashlib.sha1(null_bytes).digest()
+        null_image = Image.open(BytesIO(null_bytes))
+        self._null_mode, self._null_dims = null_image.mode, null_image.size
+        self._null_hash = self._hash_image(null_image)
           
         self.tgtfolder = tgtFolder
         try:
@@ -45,36 +117,103 @@ class BingAerialImage(object):
         """
         Retrieve the currently available URL for Bing's Aerial Imagery REST API by pinging the official interface.
         This guarantees that the most up-to-date API will always be used.
+        The response is cached on disk and shared by all instances of the process, see _fetch_bing_meta.
         """
-        r = requests.get(BING_AVAILABILITY_URL + self.api_key)
-        if r.status_code != 200:
-            raise Exception("API Call to Bing Maps failed.")
-            sys.exit()
-        
-        self.baseURL = r.json()["resourceSets"][0]["resources"][0]["imageUrl"]
-        self.subdomains = r.json()["resourceSets"][0]["resources"][0]["imageUrlSubdomains"]
-        self.tileSize = r.json()["resourceSets"][0]["resources"][0]["imageHeight"]
-        self.maxZoom = r.json()["resourceSets"][0]["resources"][0]["zoomMax"]
+        self.baseURL, self.subdomains, self.tileSize, self.maxZoom = _fetch_bing_meta(self.api_key)
     
     
-    def download_image(self, quadkey):
-        """This method is used to download a tile image given the quadkey from Bing tile system
+    def _check_availability(self, level):
+        """Ask Bing's imagery metadata service whether aerial imagery exists at the given level,
+        so a level without imagery can be skipped before any tile is downloaded
+
+        The service answers for the center of the bounding box; without imagery at that level
+        it returns no vintage dates.
+        
+        Arguments:
+            level {[int]} -- [level used to retrieve image]
+        
+        Returns:
+            [boolean] -- [whether imagery is available at that level]
+        """
+
+        url = BING_POINT_METADATA_URL.format(lat=self.lat, lon=self.lon, zl=level) + self.api_key
+        # do not rule the level out if the service itself fails, the tile check still applies
+        try:
+            r = self.session.get(url, timeout=10)
+            if r.status_code != 200:
+                return True
+            resource = r.json()["resourceSets"][0]["resources"][0]
+        except (requests.RequestException, ValueError, KeyError, IndexError):
+            return True
+        return resource.get("vintageEnd") is not None
+
+    def download_tile(self, quadkey, subdomain=None):
+        """This method is used to download the raw, still encoded bytes of a tile image given the quadkey from Bing tile system
         
         Arguments:
             quadkey {[string]} -- [The quadkey for a tile image]
+            subdomain {[string]} -- [The Bing tile server to query, defaults to the first available one]
         
         Returns:
-            [Image] -- [A PIL Image]
+            [bytes] -- [The encoded tile image]
         """
 
-        with request.urlopen(self.baseURL.format(subdomain=self.subdomains[0],quadkey=quadkey)) as file:
-            return Image.open(file)
- 
+        if subdomain is None:
+            subdomain = self.subdomains[0]
+        r = self.session.get(self.baseURL.format(subdomain=subdomain, quadkey=quadkey), timeout=10)
+        r.raise_for_status()
+        return r.content
+
+    def _fetch_null(self):
+        """Load the raw bytes of the NULL image Bing returns for non-existing tiles, downloading and caching it as NULL_TILE if needed
+        
+        Returns:
+            [bytes] -- [the encoded NULL image, exactly as served by Bing]
+        """
+
+        if not os.path.exists(NULL_TILE):
+            null_bytes = self.download_tile('11111111111111111111')      # an invalid quadkey which will download a null image from Bing tile system
+            tmp = "{}.{}.tmp".format(NULL_TILE, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(null_bytes)
+            os.replace(tmp, NULL_TILE)
+            return null_bytes
+        with open(NULL_TILE, 'rb') as f:
+            return f.read()
+
+    def _is_null(self, data):
+        """Check whether downloaded tile bytes are the NULL image, without decoding them.
+        Almost every valid tile already differs in length, so the hash is rarely computed.
+        
+        Arguments:
+            data {[bytes]} -- [the encoded tile image]
+        
+        Returns:
+            [boolean] -- [whether the tile is the NULL image]
+        """
+
+        return len(data) == self._null_size and hashlib.sha1(data).digest() == self._null_sha
+
+    @staticmethod
+    def _hash_image(image):
+        """Hash the pixel data of an image, so tiles can be compared without a pixel-wise comparison
+        
+        Arguments:
+            image {[Image]} -- [the image to hash]
+        
+        Returns:
+            [bytes] -- [16 byte digest of the image's pixel data]
+        """
+
+        return hashlib.blake2b(image.tobytes(), digest_size=16).digest()
+
     def is_valid_image(self, image):
         """Check whether the downloaded image is valid, 
         by comparing the downloaded image with a NULL image returned by any unsuccessfully retrieval
 
         Bing tile system will return the same NULL image if the query quadkey is not existed in the Bing map database.
+        This is the fallback for tiles whose bytes differ from NULL_TILE, e.g. when Bing re-encodes its NULL image.
+        Only images with the NULL image's mode and size are hashed, so regular JPEG tiles skip the hash.
         
         Arguments:
             image {[Image]} -- [a Image type image to be valided]
@@ -83,10 +222,26 @@ class BingAerialImage(object):
             [boolean] -- [whether the image is valid]
         """
 
-        if not os.path.exists('null.png'):
-            nullimg = self.download_image('11111111111111111111')      # an invalid quadkey which will download a null jpeg from Bing tile system
-            nullimg.save('./null.png')
-        return not (image == Image.open('./null.png'))
+        if image.mode != self._null_mode or image.size != self._null_dims:
+            return True
+        return self._hash_image(image) != self._null_hash
+
+    def _pixel_bounds(self, level):
+        """Project the bounding box into pixel coordinates at the given level
+        
+        Arguments:
+            level {[int]} -- [level of detail]
+        
+        Returns:
+            [tuple] -- [(pixelX1, pixelY1, pixelX2, pixelY2) of the upper left and lower right pixel]
+        """
+
+        pixelX1, pixelY1 = ts.latLongToPixelXY(self.upper_left[0], self.upper_left[1], level)
+        pixelX2, pixelY2 = ts.latLongToPixelXY(self.lower_right[0], self.lower_right[1], level)
+
+        pixelX1, pixelX2 = min(pixelX1, pixelX2), max(pixelX1, pixelX2)
+        pixelY1, pixelY2 = min(pixelY1, pixelY2), max(pixelY1, pixelY2)
+        return pixelX1, pixelY1, pixelX2, pixelY2
 
     def max_resolution_imagery_retrieval(self):
         """The main aerial retrieval method
@@ -104,13 +259,22 @@ class BingAerialImage(object):
             [boolean] -- [indicate whether the aerial image retrieval is successful]
         """
 
-        for levl in range(self.maxZoom, 0, -1):
-            pixelX1, pixelY1 = ts.latLongToPixelXY(self.upper_left[0], self.upper_left[1], levl)
-            pixelX2, pixelY2 = ts.latLongToPixelXY(self.lower_right[0], self.lower_right[1], levl)
-
-            pixelX1, pixelX2 = min(pixelX1, pixelX2), max(pixelX1, pixelX2)
-            pixelY1, pixelY2 = min(pixelY1, pixelY2), max(pixelY1, pixelY2)
+        # the image area grows monotonically with the level, so binary search the highest level within MAXSIZE
+        lo, hi = 1, self.maxZoom
+        best = 0
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            pixelX1, pixelY1, pixelX2, pixelY2 = self._pixel_bounds(mid)
+            if (pixelX2 - pixelX1) * (pixelY2 - pixelY1) > MAXSIZE:
+                hi = mid - 1
+            else:
+                best = mid
+                lo = mid + 1
+        if best < self.maxZoom:
+            print("Levels above {} result in an image exceeding the maximum image size (8192 * 8192), will SKIP".format(best))
 
+        for levl in range(best, 0, -1):
+            pixelX1, pixelY1, pixelX2, pixelY2 = self._pixel_bounds(levl)
             
             #Bounding box's two coordinates coincide at the same pixel, which is invalid for an aerial image.
             #Raise error and directly return without retriving any valid image.
@@ -118,29 +282,52 @@ class BingAerialImage(object):
                 print("Cannot find a valid aerial imagery for the given bounding box!")
                 return
 
-            if abs(pixelX1 - pixelX2) * abs(pixelY1 - pixelY2) > MAXSIZE:
-                print("Current level {} results an image exceeding the maximum image size (8192 * 8192), will SKIP".format(levl))
+            if not self._check_availability(levl):
+                print("No aerial imagery available at level {}, will SKIP".format(levl))
                 continue
-            
+
             tileX1, tileY1 = ts.pixelXYToTileXY(pixelX1, pixelY1)
             tileX2, tileY2 = ts.pixelXYToTileXY(pixelX2, pixelY2)
 
-            # Stitch the tile images together
-            result = Image.new('RGB', ((tileX2 - tileX1 + 1) * self.tileSize, (tileY2 - tileY1 + 1) * self.tileSize))
-            retrieve_sucess = False
-            for tileY in range(tileY1, tileY2 + 1):
-                retrieve_sucess, horizontal_image = self.horizontal_retrieval_and_stitch_image(tileX1, tileX2, tileY, levl)
-                if not retrieve_sucess:
-                    break
-                result.paste(horizontal_image, (0, (tileY - tileY1) * self.tileSize))
+            # tile grid as parallel arrays, row by row from the upper left tile
+            tys, txs = np.meshgrid(np.arange(tileY1, tileY2 + 1), np.arange(tileX1, tileX2 + 1), indexing='ij')
+            txs, tys = txs.ravel(), tys.ravel()
+            quadkeys = np.array(ts.tileRangeToQuadKeys(tileX1, tileY1, tileX2, tileY2, levl))
+
+            # intersection of every tile with the bounding box, as offsets within the tile (src) and the output image (dst)
+            tile_xs, tile_ys = txs * self.tileSize, tys * self.tileSize
+            src_xs, src_ys = np.maximum(pixelX1 - tile_xs, 0), np.maximum(pixelY1 - tile_ys, 0)
+            dst_xs, dst_ys = np.maximum(tile_xs - pixelX1, 0), np.maximum(tile_ys - pixelY1, 0)
+            widths = np.minimum(tile_xs + self.tileSize, pixelX2) - np.maximum(tile_xs, pixelX1)
+            heights = np.minimum(tile_ys + self.tileSize, pixelY2) - np.maximum(tile_ys, pixelY1)
+
+            # tiles only touching the bounding box on its edge contribute no pixels, do not download them
+            keep = (widths > 0) & (heights > 0)
+            txs, tys, quadkeys = txs[keep], tys[keep], quadkeys[keep]
+            boxes = np.stack([src_xs, src_ys, dst_xs, dst_ys, widths, heights], axis=1)[keep]
 
-            if not retrieve_sucess:
+            # Download all tiles concurrently, each one decoded straight into its part of the output image
+            canvas = np.empty((pixelY2 - pixelY1, pixelX2 - pixelX1, 3), dtype=np.uint8)
+            # stop downloading as soon as one tile is missing, the level is unusable then
+            stop = threading.Event()
+            fetch = partial(self._fetch, canvas=canvas, stop=stop)
+            executor = ThreadPoolExecutor(max_workers=MAXWORKERS)
+            missing = None
+            try:
+                futures = {executor.submit(fetch, quadkey, box, i): i for i, (quadkey, box) in enumerate(zip(quadkeys, boxes))}
+                for future in as_completed(futures):
+                    if future.result() is False:
+                        missing = futures[future]
+                        stop.set()
+                        break
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+            if missing is not None:
+                print("Cannot find tile image at level {0} for tile coordinate ({1}, {2})".format(levl, txs[missing], tys[missing]))
                 continue
 
-            # Crop the image based on the given bounding box
-            leftup_cornerX, leftup_cornerY = ts.tileXYToPixelXY(tileX1, tileY1)
-            retrieve_image = result.crop((pixelX1 - leftup_cornerX, pixelY1 - leftup_cornerY, \
-                                        pixelX2 - leftup_cornerX, pixelY2 - leftup_cornerY))
+            retrieve_image = Image.fromarray(canvas)
             
             date_string = datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
             
@@ -152,33 +339,42 @@ class BingAerialImage(object):
             
 
 
-    def horizontal_retrieval_and_stitch_image(self, tileX_start, tileX_end, tileY, level):
-        """Horizontally retrieve tile images and then stitch them together,
-        start from tileX_start and end at tileX_end, tileY will remain the same
+    def _fetch(self, quadkey, box, i, canvas, stop):
+        """Download a single tile, spreading requests round-robin over the available subdomains,
+        and write the part of it inside the bounding box into the canvas if it is valid
         
         Arguments:
-            tileX_start {[int]} -- [the starting tileX index]
-            tileX_end {[int]} -- [the ending tileX index]
-            tileY {[int]} -- [the tileY index]
-            level {[int]} -- [level used to retrieve image]
+            quadkey {[string]} -- [The quadkey of the tile to download]
+            box {[ndarray]} -- [(src_x, src_y, dst_x, dst_y, width, height) of the tile's part within the canvas]
+            i {[int]} -- [index of the tile, used to pick the subdomain]
+            canvas {[ndarray]} -- [(H, W, 3) uint8 array holding the output image]
+            stop {[Event]} -- [set once any tile of the level is missing, remaining tiles are skipped]
         
         Returns:
-            [boolean, Image] -- [whether such retrieval is successful; If successful, returning the stitched image, otherwise None]
+            [boolean] -- [whether the tile is valid, None if it was skipped]
         """
 
-        imagelist = []
-        for tileX in range(tileX_start, tileX_end + 1):
-            quadkey = ts.tileXYToQuadKey(tileX, tileY, level)
-            image = self.download_image(quadkey)
-            if self.is_valid_image(image):
-                imagelist.append(image)
-            else:
-                print("Cannot find tile image at level {0} for tile coordinate ({1}, {2})".format(level, tileX, tileY))
-                return False, None
-        result = Image.new('RGB', (len(imagelist) * self.tileSize, self.tileSize))
-        for i, image in enumerate(imagelist):
-            result.paste(image, (i * self.tileSize, 0))
-        return True, result       
+        if stop.is_set():
+            return None
+        subdomain = self.subdomains[i % len(self.subdomains)]
+        data = self.download_tile(str(quadkey), subdomain)
+        if self._is_null(data):
+            stop.set()
+            return False
+        if stop.is_set():
+            return None
+        # the tile is decoded once and only the part inside the bounding box is copied, straight into the canvas
+        image = Image.open(BytesIO(data))
+        if not self.is_valid_image(image):
+            stop.set()
+            return False
+        src_x, src_y, dst_x, dst_y, w, h = (int(v) for v in box)
+        if w != image.width or h != image.height:
+            image = image.crop((src_x, src_y, src_x + w, src_y + h))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        canvas[dst_y:dst_y + h, dst_x:dst_x + w] = np.asarray(image)
+        return True
 
         
 def main():